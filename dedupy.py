@@ -2,13 +2,47 @@
 
 """Identify duplicate files."""
 
-import argparse
+import collections
+import concurrent.futures
 import datetime
+import functools
 import hashlib
-import json
 import os
-from collections import Counter
 import logging
+import mmap
+import stat
+import sys
+import threading
+import types
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+
+SMALL_FILE_SIZE = 4 * 1024
+# Up to 16 MiB of small-file contents held as grouping keys per cluster.
+SMALL_FILE_GROUPING_MAX_FILES = 4096
+HEAD_SIZE = 64 * 1024
+TAIL_SIZE = 4 * 1024
+MMAP_THRESHOLD = 256 * 1024
+READ_CHUNK_SIZE = 1024 * 1024
+BLOCK_HASH_THRESHOLD = 128 * 1024 * 1024
+BLOCK_SIZE = 64 * 1024 * 1024
+# Every file of a cluster hashed progressively stays open until it is ruled
+# out, so larger clusters are hashed file by file instead. The total across
+# all clusters is capped well below common open-file limits (256 on macOS).
+PROGRESSIVE_MAX_FILES = 32
+PROGRESSIVE_MAX_OPEN_FILES = 128
+BLOCK_HASH_JOBS = 16
+
+FAST_FINGERPRINT_ALGORITHM = "xxh3_64"
 
 
 def setup_logging(debug):
@@ -16,137 +50,861 @@ def setup_logging(debug):
     logging.basicConfig(level=level, format="%(asctime)s - %(levelname)s - %(message)s")
 
 
-def add_file_to_size_map(
-    fullname: str,
-    file_count: Counter,
+def add_files_to_size_map(
+    files: list,
+    seen_file_ids: set,
+    first_filename_by_size: dict,
     size_filename_dict: dict,
-    args,
+    ignore_zero_length: bool,
 ):
-    try:
-        stat_obj = os.stat(fullname)
-    except (PermissionError, FileNotFoundError):
-        return
-    file_id = (stat_obj.st_dev, stat_obj.st_ino)
-    if file_count[file_id] == 0:
-        file_count[file_id] += 1
+    # Takes a whole directory's worth of (path, stat) pairs per call; this is
+    # the per-file hot loop of the scan, so it sticks to local names.
+    seen_add = seen_file_ids.add
+    for fullname, stat_obj in files:
         file_size = stat_obj.st_size
-        if not (args.ignore_zero_length and file_size == 0):
-            size_filename_dict.setdefault(file_size, []).append(fullname)
+        # Tested size-first: most files are non-empty, so the flag is rarely
+        # even looked at.
+        if not file_size and ignore_zero_length:
+            continue
+        file_id = (stat_obj.st_dev, stat_obj.st_ino)
+        if file_id in seen_file_ids:
+            continue
+        seen_add(file_id)
+        # A size only gets a list once a second file of that size shows up,
+        # so sizes seen once never reach the hashing stage.
+        if file_size in size_filename_dict:
+            size_filename_dict[file_size].append(fullname)
+        elif file_size in first_filename_by_size:
+            size_filename_dict[file_size] = [
+                first_filename_by_size.pop(file_size),
+                fullname,
+            ]
+        else:
+            first_filename_by_size[file_size] = fullname
 
 
-def process_directory(
-    start_dir: str,
-    file_count: Counter,
+def scan_directory(path: str, include_hidden_files: bool):
+    files = []
+    subdirs = []
+    skip_hidden = not include_hidden_files
+    try:
+        it = os.scandir(path)
+    except OSError:
+        return files, subdirs
+    with it:
+        for entry in it:
+            if skip_hidden and entry.name[:1] == ".":
+                continue
+            # A bad entry (e.g. a symlink loop, ELOOP) only skips itself.
+            try:
+                if entry.is_dir():
+                    # Like os.walk, symlinked directories are not descended
+                    # into.
+                    if not entry.is_symlink():
+                        subdirs.append(entry.path)
+                    continue
+                # is_dir()/is_file() come from the directory listing itself,
+                # so FIFOs, sockets, devices and dangling links are dropped
+                # without a stat call (and never opened for hashing).
+                if not entry.is_file():
+                    continue
+                files.append((entry.path, entry.stat()))
+            except OSError:
+                continue
+    return files, subdirs
+
+
+def walk_directories(start_dirs: list, include_hidden_files: bool, walk_jobs: int):
+    # Directories are listed on the pool, but results are consumed in
+    # submission order, so the files (and which of several hard links is kept)
+    # come out the same on every run. This thread alone schedules
+    # subdirectories, so no locking is needed.
+    with concurrent.futures.ThreadPoolExecutor(max_workers=walk_jobs) as executor:
+        pending = collections.deque(
+            executor.submit(scan_directory, start_dir, include_hidden_files)
+            for start_dir in start_dirs
+        )
+        while pending:
+            files, subdirs = pending.popleft().result()
+            for subdir in subdirs:
+                pending.append(
+                    executor.submit(scan_directory, subdir, include_hidden_files)
+                )
+            yield files
+
+
+def process_directories(
+    start_dirs: list,
+    seen_file_ids: set,
+    first_filename_by_size: dict,
     size_filename_dict: dict,
     args,
 ):
-    for path, dirs, files in os.walk(start_dir):
-        if not args.include_hidden_files:
-            dirs[:] = [d for d in dirs if not d.startswith(".")]
-        for filename in files:
-            if args.include_hidden_files or not filename.startswith("."):
-                fullname = os.path.realpath(os.path.join(path, filename))
-                add_file_to_size_map(fullname, file_count, size_filename_dict, args)
+    for files in walk_directories(
+        start_dirs, args.include_hidden_files, args.walk_jobs
+    ):
+        add_files_to_size_map(
+            files,
+            seen_file_ids,
+            first_filename_by_size,
+            size_filename_dict,
+            args.ignore_zero_length,
+        )
 
 
 def group_files_by_size(items: list, args) -> dict:
-    file_count = Counter()
+    seen_file_ids = set()
+    first_filename_by_size = {}
     size_filename_dict = {}
+    start_dirs = []
 
     for item in items:
-        if os.path.isdir(item):
-            process_directory(item, file_count, size_filename_dict, args)
-        else:
-            add_file_to_size_map(item, file_count, size_filename_dict, args)
+        try:
+            stat_obj = os.stat(item)
+        except (PermissionError, FileNotFoundError):
+            continue
+        if stat.S_ISDIR(stat_obj.st_mode):
+            # Walking from an absolute path makes every DirEntry.path absolute,
+            # so resolving reported paths never has to call os.getcwd().
+            start_dirs.append(os.path.abspath(item))
+        elif stat.S_ISREG(stat_obj.st_mode):
+            add_files_to_size_map(
+                [(item, stat_obj)],
+                seen_file_ids,
+                first_filename_by_size,
+                size_filename_dict,
+                args.ignore_zero_length,
+            )
+    process_directories(
+        start_dirs, seen_file_ids, first_filename_by_size, size_filename_dict, args
+    )
 
     return size_filename_dict
 
 
-def hash_list_of_files(list_of_filenames: list, hash_func_name: str) -> dict:
+# Shared by all hashing threads; block tasks never submit further work, so
+# they cannot deadlock waiting on each other.
+block_executor = concurrent.futures.ThreadPoolExecutor(max_workers=BLOCK_HASH_JOBS)
+
+
+def hash_constructor(hash_func_name: str):
+    # Resolve the name once. The named constructors (hashlib.sha256 etc.)
+    # skip the registry lookup that hashlib.new does on every call; every
+    # accepted name other than blake3 is in hashlib.algorithms_guaranteed,
+    # which all have one.
+    if hash_func_name == FAST_FINGERPRINT_ALGORITHM:
+        return xxhash.xxh3_64
+    if hash_func_name == "blake3":
+        return blake3.blake3
+    return getattr(hashlib, hash_func_name)
+
+
+O_NOATIME = getattr(os, "O_NOATIME", 0)
+
+
+def open_for_hashing(filename: str, buffering: int = 0):
+    # O_NOATIME saves an inode write per file read, but the kernel only
+    # allows it on files we own; anything else is opened normally.
+    flags = os.O_RDONLY | getattr(os, "O_BINARY", 0)
+    try:
+        fd = os.open(filename, flags | O_NOATIME)
+    except PermissionError:
+        if not O_NOATIME:
+            raise
+        fd = os.open(filename, flags)
+    return open(fd, "rb", buffering=buffering)
+
+
+def read_exactly(f, size: int) -> bytes:
+    # Raw reads may come back short (FUSE, network filesystems), so keep
+    # reading until size bytes or EOF. Locally the first read is the only one.
+    data = f.read(size)
+    while len(data) < size and (more := f.read(size - len(data))):
+        data += more
+    return data
+
+
+def advise_done_reading(fd: int) -> None:
+    # Data read only to be hashed is not worth keeping in the page cache.
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+def advise_sequential_read(fd: int) -> None:
+    if hasattr(os, "posix_fadvise"):
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+
+
+def update_hash_from_file(hash_obj, f, file_size: int, buf: bytearray) -> None:
+    if file_size >= MMAP_THRESHOLD:
+        try:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                if hasattr(mmap, "MADV_SEQUENTIAL"):
+                    mm.madvise(mmap.MADV_SEQUENTIAL)
+                    mm.madvise(mmap.MADV_WILLNEED)
+                hash_obj.update(mm)
+            return
+        except (OSError, ValueError):
+            pass
+    # Stop once the expected size is read rather than issuing one more read
+    # just to see EOF; most files fit in a single read.
+    view = memoryview(buf)
+    remaining = file_size
+    while n := f.readinto(buf):
+        hash_obj.update(view[:n])
+        remaining -= n
+        if remaining <= 0:
+            break
+
+
+def hash_block(fd: int, offset: int, hash_ctor) -> bytes:
+    hash_obj = hash_ctor()
+    end = offset + BLOCK_SIZE
+    if not hasattr(os, "preadv"):
+        while offset < end:
+            chunk = os.pread(fd, min(READ_CHUNK_SIZE, end - offset), offset)
+            if not chunk:
+                break
+            hash_obj.update(chunk)
+            offset += len(chunk)
+        return hash_obj.digest()
+
+    # preadv fills the thread's reused buffer instead of allocating a new
+    # bytes object for every chunk.
+    view = memoryview(read_buffer())
+    while offset < end:
+        n = os.preadv(fd, [view[: min(len(view), end - offset)]], offset)
+        if not n:
+            break
+        hash_obj.update(view[:n])
+        offset += n
+    return hash_obj.digest()
+
+
+def block_hash_file(fd: int, file_size: int, hash_ctor) -> str:
+    # Note: this is the digest of the concatenated per-block digests, not the
+    # plain digest of the file contents. It is only comparable within dedupy.
+    block_digests = block_executor.map(
+        lambda offset: hash_block(fd, offset, hash_ctor),
+        range(0, file_size, BLOCK_SIZE),
+    )
+    hash_obj = hash_ctor()
+    hash_obj.update(b"".join(block_digests))
+    return hash_obj.hexdigest()
+
+
+def hash_open_file(f, hash_ctor, buf: bytearray) -> str:
+    file_size = os.fstat(f.fileno()).st_size
+    advise_sequential_read(f.fileno())
+    if (
+        file_size >= BLOCK_HASH_THRESHOLD
+        and blake3 is not None
+        and hash_ctor is blake3.blake3
+    ):
+        # BLAKE3 is a tree hash and can spread one file over all cores itself,
+        # so large files get the plain digest instead of per-block digests.
+        hash_obj = blake3.blake3(max_threads=blake3.blake3.AUTO)
+        update_hash_from_file(hash_obj, f, file_size, buf)
+        digest = hash_obj.hexdigest()
+    elif file_size >= BLOCK_HASH_THRESHOLD and hasattr(os, "pread"):
+        digest = block_hash_file(f.fileno(), file_size, hash_ctor)
+    else:
+        hash_obj = hash_ctor()
+        update_hash_from_file(hash_obj, f, file_size, buf)
+        digest = hash_obj.hexdigest()
+    advise_done_reading(f.fileno())
+    return digest
+
+
+DEFAULT_CACHE_FILE = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.expanduser("~/.cache"),
+    "dedupy",
+    "hashes.db",
+)
+CACHE_BATCH_SIZE = 1000
+
+
+class HashCache:
+    """Digests from earlier runs, keyed by inode and invalidated by mtime/size."""
+
+    def __init__(self, filename: str):
+        import sqlite3  # Only needed with --cache.
+
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        self.connection = sqlite3.connect(filename, check_same_thread=False)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS hashes ("
+            "dev INTEGER, ino INTEGER, algorithm TEXT, mtime_ns INTEGER,"
+            " size INTEGER, digest TEXT, PRIMARY KEY (dev, ino, algorithm))"
+        )
+        self.lock = threading.Lock()
+        self.pending = []
+
+    def lookup(self, filename: str, algorithm: str):
+        stat_obj = os.stat(filename)
+        file_key = (
+            stat_obj.st_dev,
+            stat_obj.st_ino,
+            stat_obj.st_mtime_ns,
+            stat_obj.st_size,
+        )
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT digest FROM hashes WHERE dev = ? AND ino = ?"
+                " AND mtime_ns = ? AND size = ? AND algorithm = ?",
+                (*file_key, algorithm),
+            ).fetchone()
+        return file_key, row[0] if row else None
+
+    def store(self, file_key: tuple, algorithm: str, digest: str) -> None:
+        with self.lock:
+            self.pending.append((*file_key, algorithm, digest))
+            if len(self.pending) >= CACHE_BATCH_SIZE:
+                self.flush()
+
+    def flush(self) -> None:
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO hashes"
+                " (dev, ino, mtime_ns, size, algorithm, digest)"
+                " VALUES (?, ?, ?, ?, ?, ?)",
+                self.pending,
+            )
+        self.pending.clear()
+
+    def close(self) -> None:
+        with self.lock:
+            self.flush()
+            self.connection.close()
+
+
+thread_local = threading.local()
+
+
+def read_buffer() -> bytearray:
+    # One read buffer per thread, reused for every file that thread hashes.
+    if not hasattr(thread_local, "buf"):
+        thread_local.buf = bytearray(READ_CHUNK_SIZE)
+    return thread_local.buf
+
+
+def pair_buffer() -> bytearray:
+    # A second per-thread buffer, for reading two files side by side.
+    if not hasattr(thread_local, "pair_buf"):
+        thread_local.pair_buf = bytearray(READ_CHUNK_SIZE)
+    return thread_local.pair_buf
+
+
+def hash_cached_file(filename: str, hash_func_name: str, hash_ctor, hash_cache):
+    try:
+        if hash_cache is None:
+            with open_for_hashing(filename) as f:
+                return hash_open_file(f, hash_ctor, read_buffer())
+
+        # The key is taken before reading, so a file modified while it is being
+        # hashed is simply hashed again next time.
+        file_key, digest = hash_cache.lookup(filename, hash_func_name)
+        if digest is None:
+            with open_for_hashing(filename) as f:
+                digest = hash_open_file(f, hash_ctor, read_buffer())
+            hash_cache.store(file_key, hash_func_name, digest)
+        return digest
+    except (PermissionError, FileNotFoundError):
+        return None
+
+
+def group_duplicates_by_digest(list_of_filenames: list, digests) -> dict:
+    # Groups files by digest, skipping unreadable ones (None), and keeps only
+    # the digests seen at least twice.
     map_hash_to_file_list: dict = {}
+    duplicated_digests = []
+    for filename, digest in zip(list_of_filenames, digests):
+        if digest is None:
+            continue
+        file_list = map_hash_to_file_list.setdefault(digest, [])
+        file_list.append(filename)
+        if len(file_list) == 2:
+            duplicated_digests.append(digest)
+
+    return {digest: map_hash_to_file_list[digest] for digest in duplicated_digests}
+
+
+def hash_list_of_files(
+    list_of_filenames: list,
+    hash_func_name: str,
+    hash_cache=None,
+    executor=None,
+) -> dict:
+    hash_ctor = hash_constructor(hash_func_name)
+    hash_one = functools.partial(
+        hash_cached_file,
+        hash_func_name=hash_func_name,
+        hash_ctor=hash_ctor,
+        hash_cache=hash_cache,
+    )
+    # hashlib releases the GIL while hashing, so files in one cluster can be
+    # read and hashed on several threads at once.
+    digests = (executor.map if executor else map)(hash_one, list_of_filenames)
+    return group_duplicates_by_digest(list_of_filenames, digests)
+
+
+def hash_file_ends(
+    filename: str, hash_ctor, file_size: int, head_size: int, tail_size: int
+):
+    # Files that share a header (same format, same generator) often differ
+    # only further in; the tail catches most of those for one more read.
+    tail_offset = max(head_size, file_size - tail_size)
+    try:
+        hash_obj = hash_ctor()
+        with open_for_hashing(filename) as f:
+            hash_obj.update(read_exactly(f, head_size))
+            if tail_offset < file_size:
+                f.seek(tail_offset)
+                hash_obj.update(read_exactly(f, tail_size))
+        return hash_obj.hexdigest()
+    except (PermissionError, FileNotFoundError):
+        return None
+
+
+def hash_list_of_files_ends(
+    list_of_filenames: list,
+    hash_func_name: str,
+    file_size: int,
+    head_size: int = HEAD_SIZE,
+    tail_size: int = TAIL_SIZE,
+    executor=None,
+) -> dict:
+    hash_ctor = hash_constructor(hash_func_name)
+    hash_one = functools.partial(
+        hash_file_ends,
+        hash_ctor=hash_ctor,
+        file_size=file_size,
+        head_size=head_size,
+        tail_size=tail_size,
+    )
+    # These reads are small and latency bound, so keep several in flight.
+    digests = (executor.map if executor else map)(hash_one, list_of_filenames)
+    return group_duplicates_by_digest(list_of_filenames, digests)
+
+
+def group_small_files_by_content(
+    list_of_filenames: list, hash_func_name: str, file_size: int
+) -> dict:
+    # Tiny files are grouped on their bytes directly, so only one digest per
+    # duplicate group is computed instead of one per file. Large clusters are
+    # grouped by digest instead, so the keys held in memory stay bounded.
+    hash_ctor = hash_constructor(hash_func_name)
+    by_digest = len(list_of_filenames) > SMALL_FILE_GROUPING_MAX_FILES
+    map_key_to_file_list: dict = {}
     for filename in list_of_filenames:
         try:
-            hash_obj = hashlib.new(hash_func_name)
-            with open(filename, "rb") as f:
-                while chunk := f.read(128 * hash_obj.block_size):
-                    hash_obj.update(chunk)
-                digest = hash_obj.hexdigest()
-
-                map_hash_to_file_list.setdefault(digest, []).append(filename)
+            with open_for_hashing(filename) as f:
+                key = read_exactly(f, file_size)
         except (PermissionError, FileNotFoundError):
             continue
+        if by_digest:
+            hash_obj = hash_ctor()
+            hash_obj.update(key)
+            key = hash_obj.hexdigest()
+        map_key_to_file_list.setdefault(key, []).append(filename)
+
+    out = {}
+    for key, file_list in map_key_to_file_list.items():
+        if len(file_list) > 1:
+            if not by_digest:
+                hash_obj = hash_ctor()
+                hash_obj.update(key)
+                key = hash_obj.hexdigest()
+            out[key] = file_list
+    return out
+
+
+def hash_file_pair(file_pair: list, hash_func_name: str, hash_cache=None) -> dict:
+    if hash_cache is not None:
+        try:
+            cached = [hash_cache.lookup(f, hash_func_name) for f in file_pair]
+        except (PermissionError, FileNotFoundError):
+            return {}
+        (file_key1, digest1), (file_key2, digest2) = cached
+        if digest1 is not None and digest2 is not None:
+            return {digest1: list(file_pair)} if digest1 == digest2 else {}
+
+    # Compare the two files chunk by chunk and stop at the first difference.
+    # When they match, the digest comes from the same reads.
+    hash_obj = hash_constructor(hash_func_name)()
+    buf1 = read_buffer()
+    buf2 = pair_buffer()
+    view1 = memoryview(buf1)
+    view2 = memoryview(buf2)
+    try:
+        with open_for_hashing(file_pair[0], -1) as f1, open_for_hashing(
+            file_pair[1], -1
+        ) as f2:
+            advise_sequential_read(f1.fileno())
+            advise_sequential_read(f2.fileno())
+            while n := f1.readinto(buf1):
+                if f2.readinto(buf2) != n:
+                    return {}
+                # startswith() is a plain memcmp against the view, so a short
+                # final chunk is compared without copying it (memoryview ==
+                # compares element by element and is far slower).
+                if not buf1.startswith(view2[:n]):
+                    return {}
+                hash_obj.update(view1[:n])
+            if f2.read(1):
+                return {}
+            advise_done_reading(f1.fileno())
+            advise_done_reading(f2.fileno())
+    except (PermissionError, FileNotFoundError):
+        return {}
+
+    digest = hash_obj.hexdigest()
+    if hash_cache is not None:
+        hash_cache.store(file_key1, hash_func_name, digest)
+        hash_cache.store(file_key2, hash_func_name, digest)
+    return {digest: list(file_pair)}
+
+
+def read_next_chunk(candidate: list) -> bytes:
+    # Feeds the next chunk of one open file into its running hash and returns
+    # the digest of everything read so far.
+    f, hash_obj = candidate[1], candidate[2]
+    view = memoryview(read_buffer())
+    # Raw reads may come back short (FUSE, network filesystems); every round
+    # must cover a full chunk or the end of the file would never be hashed.
+    filled = 0
+    while filled < len(view) and (n := f.readinto(view[filled:])):
+        filled += n
+    hash_obj.update(view[:filled])
+    return hash_obj.copy().digest()
+
+
+progressive_open_files = threading.Semaphore(PROGRESSIVE_MAX_OPEN_FILES)
+
+
+def reserve_progressive_files(count: int) -> bool:
+    # Takes all the slots or none, so clusters never wait on each other.
+    for taken in range(count):
+        if not progressive_open_files.acquire(blocking=False):
+            release_progressive_files(taken)
+            return False
+    return True
 
-    return map_hash_to_file_list
 
+def release_progressive_files(count: int) -> None:
+    for _ in range(count):
+        progressive_open_files.release()
 
-def remove_single_member_groups(dic: dict) -> dict:
-    return {key: value for (key, value) in dic.items() if len(value) > 1}
+
+def hash_files_progressively(
+    list_of_filenames: list,
+    hash_func_name: str,
+    file_size: int,
+    executor=None,
+) -> dict:
+    # Reads every file one chunk at a time and regroups the files by the
+    # digest of what has been read so far. A file is closed as soon as no
+    # other file shares its prefix, so files that differ early are never
+    # read to the end.
+    hash_ctor = hash_constructor(hash_func_name)
+    candidates = []
+    try:
+        for filename in list_of_filenames:
+            try:
+                f = open_for_hashing(filename)
+            except (PermissionError, FileNotFoundError):
+                continue
+            candidates.append([filename, f, hash_ctor()])
+            advise_sequential_read(f.fileno())
+
+        mapper = executor.map if executor else map
+        groups = [candidates] if len(candidates) > 1 else []
+        for _ in range(0, file_size, READ_CHUNK_SIZE):
+            if not groups:
+                break
+            members = [candidate for group in groups for candidate in group]
+            new_groups: dict = {}
+            for candidate, digest in zip(members, mapper(read_next_chunk, members)):
+                new_groups.setdefault(digest, []).append(candidate)
+            groups = []
+            for group in new_groups.values():
+                if len(group) > 1:
+                    groups.append(group)
+                else:
+                    group[0][1].close()
+
+        out_dict = {}
+        for group in groups:
+            out_dict[group[0][2].hexdigest()] = [candidate[0] for candidate in group]
+            for candidate in group:
+                advise_done_reading(candidate[1].fileno())
+        return out_dict
+    finally:
+        for candidate in candidates:
+            candidate[1].close()
 
 
 def hash_file_list(list_of_files: list, hash_func_name: str, args) -> dict:
     logging.debug("Num files to hash: %d", len(list_of_files))
 
     start_time = datetime.datetime.now()
-    out = hash_list_of_files(list_of_files, hash_func_name)
+    out = hash_list_of_files(
+        list_of_files, hash_func_name, args.hash_cache, args.file_executor
+    )
 
     if args.debug:
         elapsed_time = datetime.datetime.now() - start_time
         logging.debug("Hashing time: %s", elapsed_time)
 
-    return remove_single_member_groups(out)
+    return out
 
 
 def print_file_clusters(
     files_grouped_by_size: dict, digest_algorithms: list, args
 ) -> None:
-    cluster = 1
-    save_out_dict = {}
-    for key, file_list in files_grouped_by_size.items():
-        out_dict = generate_hash_dict_from_list(file_list, digest_algorithms, args)
-        if args.save:
-            save_out_dict.update(out_dict)
-        for hash_key, filenames in out_dict.items():
-            print(
-                f"{len(filenames)} files in cluster {cluster} ({key} bytes, digest {hash_key})"
+    json_writer = JsonClusterWriter(args.save) if args.save else None
+    try:
+        clusters = find_file_clusters(files_grouped_by_size, digest_algorithms, args)
+        for cluster, (file_size, hash_key, filenames) in enumerate(clusters, 1):
+            sys.stdout.write(
+                f"{len(filenames)} files in cluster {cluster} ({file_size} bytes, digest {hash_key})\n"
+                + "\n".join(filenames)
+                + "\n"
             )
-            for filename in filenames:
-                print(filename)
-            cluster += 1
+            if json_writer is not None:
+                json_writer.write(hash_key, filenames)
+    finally:
+        if json_writer is not None:
+            json_writer.close()
     if args.save:
-        save_dict_to_json(save_out_dict, args.save)
         print(f"Saved output to {args.save}")
 
 
+def find_file_clusters(files_grouped_by_size: dict, digest_algorithms: list, args):
+    # Yields (file size, digest, paths) for each group of duplicates, as soon
+    # as its size cluster has been hashed.
+    # Largest files first, so the long jobs start early and small ones fill in.
+    clusters = sorted(files_grouped_by_size.items(), reverse=True)
+    # Cluster threads hand their files to a separate pool. Its tasks never
+    # wait on either pool, so the nesting cannot deadlock; it is shut down
+    # last because cluster tasks submit to it.
+    args.file_executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.io_jobs)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=args.jobs)
+    with args.file_executor, executor:
+        results = executor.map(
+            lambda item: generate_hash_dict_from_list(
+                item[1], item[0], digest_algorithms, args
+            ),
+            clusters,
+        )
+        for (file_size, _), out_dict in zip(clusters, results):
+            for hash_key, filenames in out_dict.items():
+                # Paths are only resolved for files that are actually reported.
+                yield file_size, hash_key, [
+                    os.path.realpath(filename) for filename in filenames
+                ]
+
+
+def strongest_digest_algorithm(digest_algorithms: list) -> str:
+    # Ranked by digest size; on a tie the algorithm listed first wins.
+    return max(digest_algorithms, key=lambda name: hash_constructor(name)().digest_size)
+
+
 def generate_hash_dict_from_list(
-    file_list: list, digest_algorithms: list, args
+    file_list: list, file_size: int, digest_algorithms: list, args
 ) -> dict:
-    out_dict = hash_file_list(file_list, digest_algorithms[0], args)
+    # Whole files are read once, with the strongest requested algorithm, so
+    # the match never rests on a weaker digest alone; the others only serve
+    # the prefilter.
+    digest_algorithm = strongest_digest_algorithm(digest_algorithms)
+
+    if len(file_list) == 2 and file_size < BLOCK_HASH_THRESHOLD:
+        return hash_file_pair(file_list, digest_algorithm, args.hash_cache)
+
+    if file_size <= SMALL_FILE_SIZE:
+        return group_small_files_by_content(file_list, digest_algorithm, file_size)
+
+    if file_size > HEAD_SIZE:
+        # Cheap prefilter: files whose first or last blocks differ cannot be
+        # equal.
+        # Survivors are always rehashed in full with the strongest digest.
+        head_algorithm = (
+            FAST_FINGERPRINT_ALGORITHM
+            if args.fast_fingerprint and xxhash is not None
+            else digest_algorithms[0]
+        )
+        head_groups = hash_list_of_files_ends(
+            file_list, head_algorithm, file_size, executor=args.file_executor
+        )
+        num_files = len(file_list)
+        file_list = [f for group in head_groups.values() for f in group]
+        logging.debug(
+            "Head/tail prefilter kept %d of %d files", len(file_list), num_files
+        )
+        if not file_list:
+            return {}
+
+    num_candidates = len(file_list)
+    if (
+        num_candidates <= PROGRESSIVE_MAX_FILES
+        and file_size < BLOCK_HASH_THRESHOLD
+        and args.hash_cache is None
+        and reserve_progressive_files(num_candidates)
+    ):
+        try:
+            return hash_files_progressively(
+                file_list, digest_algorithm, file_size, args.file_executor
+            )
+        finally:
+            release_progressive_files(num_candidates)
+
+    return hash_file_list(file_list, digest_algorithm, args)
+
+
+class JsonClusterWriter:
+    # Written one cluster at a time so the whole result is never held in
+    # memory; the layout matches json.dump(..., indent=2).
+    def __init__(self, filename: str):
+        import json  # Only needed with --save.
 
-    for hash_func_name in digest_algorithms[1:]:
-        new_out_dict = {}
-        for new_file_list in out_dict.values():
-            new_out_dict.update(hash_file_list(new_file_list, hash_func_name, args))
-        out_dict = new_out_dict
+        self.json = json
+        self.file = open(filename, "w", encoding="utf-8")
+        self.separator = "{\n  "
 
-    return out_dict
+    def write(self, hash_key: str, filenames: list) -> None:
+        value = self.json.dumps(filenames, indent=2, ensure_ascii=False)
+        self.file.write(f"{self.separator}{self.json.dumps(hash_key)}: ")
+        self.file.write(value.replace("\n", "\n  "))
+        self.separator = ",\n  "
 
+    def close(self) -> None:
+        self.file.write("{}" if self.separator == "{\n  " else "\n}")
+        self.file.close()
 
-def save_dict_to_json(dictionary: dict, filename: str) -> None:
-    with open(filename, "w", encoding="utf-8") as f:
-        json.dump(dictionary, f, indent=2, ensure_ascii=False)
+
+def supported_digest_algorithms() -> list:
+    algorithms = sorted(hashlib.algorithms_guaranteed)
+    if blake3 is not None:
+        algorithms.insert(0, "blake3")
+    return algorithms
+
+
+def cpu_has_sha_extensions():
+    # True/False from the Linux CPU flags (x86 "sha_ni", ARM "sha2"), or None
+    # when they cannot be read.
+    try:
+        with open("/proc/cpuinfo", encoding="ascii", errors="replace") as f:
+            for line in f:
+                if line.startswith(("flags", "Features")):
+                    flags = line.partition(":")[2].split()
+                    return "sha_ni" in flags or "sha2" in flags
+    except OSError:
+        pass
+    return None
+
+
+def default_digest_algorithm() -> str:
+    # BLAKE3 vectorizes across the whole file when the package is installed.
+    # Otherwise SHA-256 is hardware accelerated (SHA-NI / ARMv8 CE) through
+    # OpenSSL on most current CPUs, which makes it faster than SHA-1 or MD5.
+    # Without those extensions SHA-512 is the faster one on 64-bit hosts.
+    if blake3 is not None:
+        return "blake3"
+    if sys.maxsize > 2**32 and cpu_has_sha_extensions() is False:
+        return "sha512"
+    for algo in ("sha256", "sha1"):
+        if algo in hashlib.algorithms_available:
+            return algo
+    return "md5"
+
+
+DEFAULT_DIGEST_ALGORITHM = default_digest_algorithm()
+
+
+# These are accelerated (SHA-NI and friends) only through OpenSSL; CPython's
+# builtin fallbacks are portable C and much slower.
+OPENSSL_ACCELERATED_ALGORITHMS = {"md5", "sha1", "sha224", "sha256", "sha384", "sha512"}
+
+
+def hash_backend(hash_func_name: str) -> str:
+    # The module implementing the hash objects, e.g. "_hashlib" for OpenSSL.
+    return type(hash_constructor(hash_func_name)()).__module__
 
 
 def list_of_digest_algorithms(arg):
     hash_algorithms = arg.split(",")
     for algo in hash_algorithms:
-        if algo not in hashlib.algorithms_guaranteed:
+        if algo not in supported_digest_algorithms():
             raise ValueError(f"Invalid hash function: {algo}")
     return hash_algorithms
 
 
+DEFAULT_JOBS = min(os.cpu_count() or 1, 16)
+DEFAULT_WALK_JOBS = 8
+# Reads are mostly waiting on the device, so keep more in flight than there
+# are CPUs.
+DEFAULT_IO_JOBS = 32
+
+
+def positive_int(arg):
+    value = int(arg)
+    if value < 1:
+        raise ValueError(f"Must be at least 1: {arg}")
+    return value
+
+
+SIMPLE_FLAGS = {
+    "-z": "ignore_zero_length",
+    "--zero": "ignore_zero_length",
+    "-a": "include_hidden_files",
+    "--all": "include_hidden_files",
+    "--debug": "debug",
+    "--fast-fingerprint": "fast_fingerprint",
+    "--cache": "cache",
+}
+
+
+def parse_simple_arguments(argv: list):
+    # Handles plain flag-and-path command lines without importing argparse.
+    # Returns None for anything else so argparse can handle (or reject) it.
+    args = types.SimpleNamespace(
+        ignore_zero_length=False,
+        include_hidden_files=False,
+        debug=False,
+        items=[],
+        digest_algorithms=[DEFAULT_DIGEST_ALGORITHM],
+        save=None,
+        fast_fingerprint=False,
+        cache=False,
+        jobs=DEFAULT_JOBS,
+        walk_jobs=DEFAULT_WALK_JOBS,
+        io_jobs=DEFAULT_IO_JOBS,
+    )
+    only_items = False
+    for arg in argv:
+        if only_items or arg == "-" or not arg.startswith("-"):
+            args.items.append(arg)
+        elif arg == "--":
+            only_items = True
+        elif arg in SIMPLE_FLAGS:
+            setattr(args, SIMPLE_FLAGS[arg], True)
+        else:
+            return None
+    return args if args.items else None
+
+
 def parse_arguments():
+    args = parse_simple_arguments(sys.argv[1:])
+    if args is not None:
+        return args
+
+    import argparse
+
     parser = argparse.ArgumentParser(
-        epilog=f"Allowed digest algorithms: {hashlib.algorithms_guaranteed}"
+        epilog="Allowed digest algorithms: " + ", ".join(supported_digest_algorithms())
     )
     parser.add_argument(
         "-z",
@@ -176,16 +934,55 @@ def parse_arguments():
         "-d",
         "--digest",
         metavar="ALGORITHM[,ALGORITHM,...]",
-        help="Specify the digest algorithms to use (default: sha1)",
+        help="Specify the digest algorithms to use; the first prefilters, the one "
+        "with the longest digest hashes whole files and is reported "
+        f" (default: {DEFAULT_DIGEST_ALGORITHM}). Except with blake3, files "
+        f"of {BLOCK_HASH_THRESHOLD // 2**20} MiB or more are reported with the "
+        f"digest of their {BLOCK_SIZE // 2**20} MiB block digests, which differs "
+        "from e.g. sha256sum output",
         type=list_of_digest_algorithms,
         dest="digest_algorithms",
-        default=["sha1"],
+        default=[DEFAULT_DIGEST_ALGORITHM],
     )
     parser.add_argument(
         "-s",
         "--save",
         help="Save the final output as a JSON file",
     )
+    parser.add_argument(
+        "--fast-fingerprint",
+        action="store_true",
+        help="Use xxHash for the head/tail prefilter (requires the xxhash package)",
+        default=False,
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help=f"Reuse digests of unchanged files from earlier runs ({DEFAULT_CACHE_FILE})",
+        default=False,
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        metavar="N",
+        help=f"Number of size clusters to hash in parallel (default: {DEFAULT_JOBS})",
+        type=positive_int,
+        default=DEFAULT_JOBS,
+    )
+    parser.add_argument(
+        "--walk-jobs",
+        metavar="N",
+        help=f"Number of directories to scan in parallel (default: {DEFAULT_WALK_JOBS})",
+        type=positive_int,
+        default=DEFAULT_WALK_JOBS,
+    )
+    parser.add_argument(
+        "--io-jobs",
+        metavar="N",
+        help=f"Number of files to read in parallel (default: {DEFAULT_IO_JOBS})",
+        type=positive_int,
+        default=DEFAULT_IO_JOBS,
+    )
 
     args = parser.parse_args()
 
@@ -193,9 +990,7 @@ def parse_arguments():
 
 
 def get_possible_duplicates_by_size(items: list, args) -> dict:
-    file_groups = group_files_by_size(items, args)
-    out = remove_single_member_groups(file_groups)
-    return out
+    return group_files_by_size(items, args)
 
 
 def main():
@@ -206,9 +1001,27 @@ def main():
 
     logging.debug("Starting dedupy")
     logging.debug("Arguments: %s", args)
+    if args.fast_fingerprint and xxhash is None:
+        logging.warning(
+            "xxhash is not installed, prefiltering with %s", args.digest_algorithms[0]
+        )
 
-    dupe_dict = get_possible_duplicates_by_size(args.items, args)
-    print_file_clusters(dupe_dict, args.digest_algorithms, args)
+    for algo in args.digest_algorithms:
+        backend = hash_backend(algo)
+        logging.debug("Hashing %s with %s", algo, backend)
+        if algo in OPENSSL_ACCELERATED_ALGORITHMS and backend != "_hashlib":
+            logging.warning(
+                "%s is not backed by OpenSSL in this Python build and will be slow",
+                algo,
+            )
+
+    args.hash_cache = HashCache(DEFAULT_CACHE_FILE) if args.cache else None
+    try:
+        dupe_dict = get_possible_duplicates_by_size(args.items, args)
+        print_file_clusters(dupe_dict, args.digest_algorithms, args)
+    finally:
+        if args.hash_cache is not None:
+            args.hash_cache.close()
 
     end_time = datetime.datetime.now()
     elapsed_time = end_time - start_time